@@ -6,9 +6,11 @@ import numpy as np
 from test_gen import generate_windows, generate_jobs
 from itertools import product
 from scheduler import HybridSchedule
+from schedule_entities import JobBatch
 import matplotlib.pyplot as plt
 import matplotlib
 from scheduler_graphics import plot_windows
+from joblib import Parallel, delayed
 
 min_window_size, max_window_size = 10, 100
 total_len = 500
@@ -24,48 +26,44 @@ hardnesses = np.linspace(1.0, 2.0, num=20)
 
 n_runs = 100
 
-quality_rate = []
-quality_block = []
-hardness_arr = []
 
-for h in hardnesses:
-    print("h = {}".format(h))
-    for _ in range(n_runs):
-        windows = list(generate_windows(min_window_size, max_window_size,
-                                        partitions, total_len))
-        jobs = list(generate_jobs(windows, h, min_job_duration,
-                                  max_job_duration, load_factor))
-
-        hardness = sum(job.length / job.duration
-                       for job in jobs) / len(jobs) # Aposteriori hardness
-        q_rate = []
-        q_block = []
-
-        scores = ['default', 'enhanced']
-        for score, window_score in product(scores, repeat=2):
-            recalc_jobs = 1.0 if score == 'enhanced' else 0.0
-            s = HybridSchedule(score, window_score, recalc_jobs)
-            s.build(jobs, min_window_size)
-            q_rate.append(s.rate())
-            q_block.append(1.0 if s.exists() else 0.0)
-
-        quality_block.append(q_block)
-        quality_rate.append(q_rate)
-        hardness_arr.append(hardness)
+def run_trial(h):
+    windows = list(generate_windows(min_window_size, max_window_size,
+                                    partitions, total_len))
+    jobs = list(generate_jobs(windows, h, min_job_duration,
+                              max_job_duration, load_factor))
+
+    batch = JobBatch(jobs)
+    hardness = (batch.lengths / batch.durations).mean() # Aposteriori hardness
+    q_rate = []
+    q_block = []
+
+    scores = ['default', 'enhanced']
+    for score, window_score in product(scores, repeat=2):
+        recalc_jobs = 1.0 if score == 'enhanced' else 0.0
+        s = HybridSchedule(score, window_score, recalc_jobs)
+        s.build_from_prepared(batch, min_window_size)
+        q_rate.append(s.rate())
+        q_block.append(1.0 if s.exists() else 0.0)
+    return q_rate, q_block, hardness
+
+
+# All the trials are independent, so run them in parallel
+trials = Parallel(n_jobs=-1, backend='loky')(delayed(run_trial)(h)
+                                             for h in np.repeat(hardnesses, n_runs))
+quality_rate, quality_block, hardness_arr = zip(*trials)
 
 quality_rate = np.array(quality_rate)
 quality_block = np.array(quality_block)
 hardness_arr = np.array(hardness_arr)
 
 hist, bins = np.histogram(hardness_arr, bins=20)
-x = [0.5 * (bins[i + 1] + bins[i])
-     for i, _ in enumerate(hist[:-5])]
-y = []
-for i, count in enumerate(hist[:-5]):
-    mask = (bins[i] <= hardness_arr) & (hardness_arr < bins[i + 1])
-    y.append(np.mean(quality_rate[mask], axis=0))
-
-y = np.array(y)
+x = 0.5 * (bins[1:] + bins[:-1])[:-5]
+# Mean quality per bin: sum of the quality values in each bin
+# (a weighted histogram) divided by the number of samples in it
+y = np.stack([np.histogram(hardness_arr, bins=bins, weights=quality_rate[:, c])[0]
+              for c in range(quality_rate.shape[1])], axis=1)
+y = y[:-5] / hist[:-5, None]
 matplotlib.rc('font', family="Courier New")
 for i in range(y.shape[1]):
     plt.plot(x, y[:, i])
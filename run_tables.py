@@ -3,7 +3,7 @@ __author__ = 'Artem Bishev'
 from test_gen import *
 import random
 import numpy as np
-from schedule_entities import Job, Window
+from schedule_entities import Job, Window, JobBatch
 from scheduler_graphics import plot_windows, plot_network
 import scheduler
 import matplotlib.pyplot as plt
@@ -35,13 +35,7 @@ min_h, max_h = [1.01, 3.0]
 hardnesses = [7, 10, 14]
 n_bins = len(hardnesses) + 1
 
-def pick_bin(hardness):
-    # Get bin idx from the hardness value
-    global hardnesses
-    for i, h in enumerate(hardnesses):
-        if hardness < h:
-            return i
-    return len(hardnesses)
+hardnesses_arr = np.asarray(hardnesses)
 
 
 tables = {table_type : np.zeros((len(load_factors), n_bins), dtype=float)
@@ -55,22 +49,22 @@ for (load_idx, load), partition_idx in product(enumerate(load_factors), [0, 1]):
     print("Load = {}, Partitions = {}\n"
           "".format(load, partitions))
 
-    counts = [0 for _ in range(n_bins)]
-    for _ in range(n_runs):
+    variants = list(product([False, True], repeat=2))
+    trial_hardness = np.empty(n_runs, dtype=float)
+    trial_rate = np.empty((n_runs, len(variants)), dtype=float)
+    trial_block = np.empty((n_runs, len(variants)), dtype=float)
+    for run in range(n_runs):
         h = random.uniform(min_h, max_h) # Apriori hardness
         windows = list(generate_windows(min_window_size, max_window_size,
                                         partitions, total_len))
         jobs = list(generate_jobs(windows, h, min_job_duration,
                                   max_job_duration, load))
-        hardness = sum(job.length / job.duration
-                       for job in jobs) / len(jobs) # Aposteriori hardness
-        # choose bin corresponding to the hardness
-        h_bin = pick_bin(hardness)
-        counts[h_bin] += 1
+        batch = JobBatch(jobs)
+        # Aposteriori hardness
+        trial_hardness[run] = (batch.lengths / batch.durations).mean()
         # plot_windows(windows, list(partitions.keys()), jobs)
 
-        scores = ['default', 'enhanced']
-        for i, j in product([False, True], repeat=2):
+        for variant, (i, j) in enumerate(variants):
             score = 'enhanced' if i else 'default'
             window_score = 'enhanced' if j else 'default'
             recalc_jobs = 1.0 if score == 'enhanced' else 0.0
@@ -78,17 +72,20 @@ for (load_idx, load), partition_idx in product(enumerate(load_factors), [0, 1]):
             s = scheduler.HybridSchedule(score=score,
                                          window_score=window_score,
                                          recalc_jobs=recalc_jobs)
-            s.build(jobs, min_window_size)
-
-            q_rate = s.rate()
-            q_block = 1.0 if s.exists() else 0.0
-
-            tables[(False, i, j, partition_idx)][load_idx, h_bin] += q_rate
-            tables[(True, i, j, partition_idx)][load_idx, h_bin] += q_block
-
-    for i, j, k in product([False, True], repeat=3):
-        for h_bin in range(n_bins):
-            tables[(i, j, k, partition_idx)][load_idx, h_bin] /= counts[h_bin]
+            s.build_from_prepared(batch, min_window_size)
+
+            trial_rate[run, variant] = s.rate()
+            trial_block[run, variant] = 1.0 if s.exists() else 0.0
+
+    # Choose bins corresponding to the hardness of all the trials at once,
+    # then sum up the quality values of the trials in each bin and average them
+    trial_bins = np.searchsorted(hardnesses_arr, trial_hardness, side='right')
+    counts = np.bincount(trial_bins, minlength=n_bins)
+    for variant, (i, j) in enumerate(variants):
+        for full, quality in [(False, trial_rate), (True, trial_block)]:
+            table = tables[(full, i, j, partition_idx)][load_idx]
+            np.add.at(table, trial_bins, quality[:, variant])
+            table /= counts
 
 
 for table_type in product([False, True], [False, True],
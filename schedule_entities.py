@@ -3,6 +3,8 @@
 __author__ = 'Artem Bishev'
 
 import sys
+from copy import copy
+import numpy as np
 
 
 class IntervalError(ValueError):
@@ -10,13 +12,31 @@ class IntervalError(ValueError):
 
 
 class Interval:
+    __slots__ = ('start', 'finish', 'length')
+
     def __init__(self, start, finish):
         if finish < start:
             raise IntervalError("End of an interval must be >= its start")
         self.start, self.finish = start, finish
+        self.length = finish - start
+
+    @classmethod
+    def unchecked(cls, start, finish):
+        '''
+        Create the interval without validating its bounds,
+        for the intervals the scheduler builds from valid ones
+        '''
+        interval = object.__new__(cls)
+        interval.start, interval.finish = start, finish
+        interval.length = finish - start
+        return interval
 
     def contains(self, other, eps=1e-3):
-        return other.start + eps >= self.start and other.finish - eps <= self.finish
+        # Intervals ending after this one are rejected first:
+        # this is the common case when one interval is tested against many
+        if other.finish - eps > self.finish:
+            return False
+        return other.start + eps >= self.start
 
     def intersect(self, other):
         try:
@@ -35,19 +55,27 @@ class Interval:
             return False
         return self.finish == other.finish and self.start == other.start
 
-    @property
-    def length(self):
-        return self.finish - self.start
+    def __hash__(self):
+        # Equal intervals have equal bounds whatever their type is
+        return hash((self.start, self.finish))
 
     def __repr__(self):
         return "Interval({}, {})".format(self.start, self.finish)
 
 
 class Window(Interval):
+    __slots__ = ('partition',)
+
     def __init__(self, start, finish, partition):
         super().__init__(start, finish)
         self.partition = partition
 
+    @classmethod
+    def unchecked(cls, start, finish, partition):
+        window = super().unchecked(start, finish)
+        window.partition = partition
+        return window
+
     def __repr__(self):
         return "Window({}, {}, {})".format(self.start,
                                            self.finish,
@@ -55,6 +83,8 @@ class Window(Interval):
 
 
 class Job(Interval):
+    __slots__ = ('partition', 'duration')
+
     def __init__(self, start, finish, partition, duration):
         super().__init__(start, finish)
         if duration < 0:
@@ -70,6 +100,84 @@ class Job(Interval):
                                         self.partition, self.duration)
 
 
+class JobBatch:
+    '''
+    Structure-of-arrays representation of a list of jobs.
+    Partitions are stored as indices into the `partitions` list
+    '''
+    def __init__(self, jobs, partitions=None):
+        if partitions is None:
+            partitions = list(set(job.partition for job in jobs))
+        self.partitions = partitions
+        part_index = {p: i for i, p in enumerate(partitions)}
+        n = len(jobs)
+        self.starts = np.fromiter((job.start for job in jobs), dtype=np.float64, count=n)
+        self.finishes = np.fromiter((job.finish for job in jobs), dtype=np.float64, count=n)
+        self.durations = np.fromiter((job.duration for job in jobs), dtype=np.float64, count=n)
+        # Times stay double: the containment tolerance is finer than
+        # the float32 resolution of typical timestamps
+        self.part_ids = np.fromiter((part_index[job.partition] for job in jobs),
+                                    dtype=np.int32, count=n)
+        self.lengths = self.finishes - self.starts
+        # Scores divide by the lengths, multiplying by their reciprocals is cheaper
+        with np.errstate(divide='ignore'):
+            self.inv_lengths = 1.0 / self.lengths
+        self.timestamps = np.unique(np.concatenate([self.starts, self.finishes]))
+        self.sorted_starts = np.sort(self.starts)
+        self.jobs = jobs
+        self.part_index = part_index
+        self.partition_masks = [self.part_ids == i for i in range(len(partitions))]
+        # Indices of the jobs grouped by partitions: jobs of the partition p are
+        # partition_order[partition_bounds[p]:partition_bounds[p + 1]]
+        self.partition_order = np.argsort(self.part_ids, kind='stable').astype(np.int32)
+        self.partition_bounds = np.searchsorted(self.part_ids[self.partition_order],
+                                                np.arange(len(partitions) + 1))
+        self.__contains_key, self.__contains_mask = None, None
+
+    def contains(self, other, eps=1e-3):
+        '''
+        Get mask of the jobs whose directive intervals contain the given one.
+        The mask of the last queried interval is cached (and must not be modified),
+        since the same candidate window is scored once for every partition
+        '''
+        key = (other.start, other.finish, eps)
+        if key != self.__contains_key:
+            self.__contains_mask = ((other.start + eps >= self.starts) &
+                                    (other.finish - eps <= self.finishes))
+            self.__contains_key = key
+        return self.__contains_mask
+
+    def in_partition(self, partition):
+        '''
+        Get mask of the jobs which belong to the given partition
+        '''
+        return self.partition_masks[self.part_index[partition]]
+
+    def active_jobs(self, time):
+        '''
+        Get the indices of the jobs which finish after the given time,
+        grouped by partitions in the same way as partition_order and partition_bounds
+        '''
+        order = self.partition_order[self.finishes[self.partition_order] > time]
+        bounds = np.searchsorted(self.part_ids[order], np.arange(len(self.partitions) + 1))
+        return order, bounds
+
+    def copy(self):
+        '''
+        Get a copy of the batch which has its own durations array
+        and shares all the other (read-only) arrays with this one
+        '''
+        batch = copy(self)
+        batch.durations = self.durations.copy()
+        return batch
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __repr__(self):
+        return "JobBatch({} jobs, partitions={})".format(len(self), self.partitions)
+
+
 def read_input_jobs():
     jobs = []
     for line in sys.stdin:
@@ -2,56 +2,96 @@
 
 __author__ = 'Artem Bishev'
 
-from copy import deepcopy
-from itertools import chain
-from schedule_entities import Job, Interval, Window, read_input_jobs
-import networkx as nx
-from networkx.algorithms.flow import preflow_push
+from schedule_entities import Job, JobBatch, Interval, Window, read_input_jobs
+from functools import partial
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.sparse.csgraph import maximum_flow
+try:
+    from numba import njit
+except ImportError:
+    njit = None
 import argparse
 
 
-def default_score(interval, job, time):
+# Upper bound of the scaled capacities in the flow network (they must fit into int32)
+FLOW_CAPACITY_LIMIT = 2 ** 30
+
+
+def default_score(length, jobs, time):
     '''
-    Get value that describes the fitness of this job to the given interval
+    Get values that describe the fitness of the jobs from the batch
+    to an interval of the given length
     '''
-    part = interval.length / job.length
-    hardness = job.duration / job.length
+    part = length * jobs.inv_lengths
+    hardness = jobs.durations * jobs.inv_lengths
     return part * hardness
 
 
-def enhanced_score(interval, job, time):
+def enhanced_score(length, jobs, time):
     '''
     This criterion explicitly includes the penalty
     for a delay between the end of previous window
     and the beginning of current window
     '''
-    part = interval.length / float(job.finish - time)
-    hardness = job.duration / float(job.finish - time)
+    inv_rest = 1.0 / (jobs.finishes - time)
+    part = length * inv_rest
+    hardness = jobs.durations * inv_rest
     return part * hardness
 
 
-def get_window_score(score, window, job, time):
+def get_window_score(score, window, jobs, time):
     '''
-    Get value that describes the fitness of this job to the given window
+    Get values that describe the fitness of the jobs to the given window
     '''
-    if job.contains(window) and window.partition == job.partition:
-        return score(window, job, time)
-    return 0.0
+    fits = jobs.contains(window) & jobs.in_partition(window.partition)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(fits, score(window.length, jobs, time), 0.0)
 
 
-def get_enhanced_window_score(score, window, job, time):
+def get_enhanced_window_score(score, window, jobs, time):
     '''
     This function includes the penalty for the window in case it
     overlaps some parts of jobs which cannot be scheduled in this window
     '''
-    aux_interval = Interval(time, window.finish)
-    if job.contains(window) and window.partition == job.partition:
-        #print ("+", score(window, job, time), end=" ")
-        return score(window, job, time)
-    elif job.have_intersection(aux_interval, strict=True) and job.partition != window.partition:
-        #print ("-", score(job.intersect(aux_interval), job, time), end=" ")
-        return -0.95*score(Interval(job.start, window.finish), job, time)
-    return 0.0
+    same_partition = jobs.in_partition(window.partition)
+    fits = jobs.contains(window) & same_partition
+    # Jobs of other partitions which strictly intersect (time, window.finish)
+    overlapped = ((jobs.starts < window.finish) & (jobs.finishes > time) &
+                  (jobs.lengths > 0) & ~same_partition)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        penalty = -0.95*score(window.finish - jobs.starts, jobs, time)
+        return np.where(fits, score(window.length, jobs, time),
+                        np.where(overlapped, penalty, 0.0))
+
+
+def get_candidate_window_scores(score, window_starts, window_finishes, jobs, time,
+                                enhanced=True):
+    '''
+    Get the total scores of all candidate windows for all partitions at once.
+    The result is an array of shape (candidates, partitions) which is equal
+    to the sums of get_window_score (or get_enhanced_window_score if enhanced)
+    over the jobs for each pair of a candidate interval and a partition
+    '''
+    eps = 1e-3
+    window_starts = np.asarray(window_starts, dtype=np.float64)[:, None]
+    window_finishes = np.asarray(window_finishes, dtype=np.float64)[:, None]
+    # Matrix (jobs, partitions) that sums the scores of the jobs of each partition
+    partition_matrix = (jobs.part_ids[:, None] ==
+                        np.arange(len(jobs.partitions))).astype(np.float64)
+    fits = ((window_starts + eps >= jobs.starts) &
+            (window_finishes - eps <= jobs.finishes))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = np.where(fits, score(window_finishes - window_starts, jobs, time), 0.0)
+        result = scores @ partition_matrix
+        if enhanced:
+            # The penalty applies to the overlapped jobs of all the other partitions
+            overlapped = ((jobs.starts < window_finishes) & (jobs.finishes > time) &
+                          (jobs.lengths > 0))
+            penalties = np.where(overlapped,
+                                 -0.95*score(window_finishes - jobs.starts, jobs, time), 0.0)
+            result += penalties.sum(axis=1, keepdims=True) - penalties @ partition_matrix
+    return result
 
 
 score_criteria = {
@@ -65,39 +105,177 @@ window_score_criteria = {
 }
 
 
-def get_acceptable_following_windows(time, jobs, min_window_size, verbose=False):
+def score_weights(enhanced, jobs, time):
     '''
-    Generate the best fitting intervals for the next window,
+    Get the weights of the jobs such that their built-in scores are equal
+    to the length of the interval multiplied by the weights: the durations
+    divided by the squared remaining parts of the directive intervals
+    for the enhanced score or by their squared lengths for the default one
+    '''
+    if enhanced:
+        with np.errstate(divide='ignore'):
+            inverses = 1.0 / (jobs.finishes - time)
+    else:
+        inverses = jobs.inv_lengths
+    with np.errstate(invalid='ignore'):
+        weights = jobs.durations * inverses * inverses
+    # Jobs which are finished or have zero length never score
+    weights[~np.isfinite(weights)] = 0.0
+    return weights
+
+
+def _window_fit_scores(window_start, window_finish, window_part, time, starts, finishes,
+                       lengths, weights, part_ids, partition_order, partition_bounds, scores):
+    '''
+    Compiled equivalent of get_window_score, the score criterion is defined
+    by the weights of the jobs (see score_weights). Fills the scores array and returns
+    the total score of the window. The jobs to visit are given grouped by
+    partitions (see JobBatch.active_jobs), only the jobs of the window's partition
+    among them are visited, so the scores of all the other jobs are left untouched
+    '''
+    eps = 1e-3
+    total = 0.0
+    window_length = window_finish - window_start
+    for k in range(partition_bounds[window_part], partition_bounds[window_part + 1]):
+        i = partition_order[k]
+        score = 0.0
+        if window_start + eps >= starts[i] and window_finish - eps <= finishes[i]:
+            score = window_length * weights[i]
+        scores[i] = score
+        total += score
+    return total
+
+
+def _window_penalized_scores(window_start, window_finish, window_part, time, starts, finishes,
+                             lengths, weights, part_ids, partition_order, partition_bounds,
+                             scores):
+    '''
+    Compiled equivalent of get_enhanced_window_score,
+    see _window_fit_scores for the arguments. All the given jobs are visited
+    '''
+    eps = 1e-3
+    total = 0.0
+    window_length = window_finish - window_start
+    for k in range(partition_bounds[len(partition_bounds) - 1]):
+        i = partition_order[k]
+        # The loop body has no branches: both terms are combined by selects
+        # (and the masks by bitwise operators), so it can be vectorized
+        fits = ((part_ids[i] == window_part) & (window_start + eps >= starts[i]) &
+                (window_finish - eps <= finishes[i]))
+        overlapped = ((part_ids[i] != window_part) & (starts[i] < window_finish) &
+                      (finishes[i] > time) & (lengths[i] > 0))
+        length = window_length if fits else window_finish - starts[i]
+        coef = 1.0 if fits else -0.95
+        score = coef * (length * weights[i])
+        score = score if fits | overlapped else 0.0
+        scores[i] = score
+        total += score
+    return total
+
+
+def _best_window(penalized, window_starts, window_finishes, partitions_count, time,
+                 starts, finishes, lengths, weights, part_ids, partition_order,
+                 partition_bounds, scores):
+    '''
+    Compiled search of the best candidate window over all the partitions.
+    The penalized flag chooses the kernel of the enhanced window criterion.
+    Returns the indices of the best candidate and partition and its score
+    '''
+    # The score of a window is at most its length multiplied by the sum of
+    # the weights of the unfinished jobs of its partition (penalties
+    # are negative), the candidates whose bound can't beat the best are skipped
+    upper_bounds = np.zeros(partitions_count)
+    for k in range(partition_bounds[partitions_count]):
+        i = partition_order[k]
+        if finishes[i] > time:
+            upper_bounds[part_ids[i]] += weights[i]
+    best_idx, best_part, best_score = -1, -1, 0.0
+    for w in range(len(window_starts)):
+        window_length = window_finishes[w] - window_starts[w]
+        for p in range(partitions_count):
+            # The slack covers the rounding errors of the bound
+            if best_idx >= 0 and window_length * upper_bounds[p] * (1.0 + 1e-9) < best_score:
+                continue
+            # Kernels are chosen per window rather than passed as an argument:
+            # numba can't cache functions which take other compiled functions
+            if penalized:
+                total = _window_penalized_scores(window_starts[w], window_finishes[w], p, time,
+                                                 starts, finishes, lengths, weights, part_ids,
+                                                 partition_order, partition_bounds, scores)
+            else:
+                total = _window_fit_scores(window_starts[w], window_finishes[w], p, time,
+                                           starts, finishes, lengths, weights, part_ids,
+                                           partition_order, partition_bounds, scores)
+            if best_idx < 0 or total > best_score:
+                best_idx, best_part, best_score = w, p, total
+    return best_idx, best_part, best_score
+
+
+if njit is not None:
+    _window_fit_scores = njit(cache=True, fastmath=True)(_window_fit_scores)
+    _window_penalized_scores = njit(cache=True, fastmath=True)(_window_penalized_scores)
+    _best_window = njit(cache=True, fastmath=True)(_best_window)
+
+# Compiled kernels of the built-in window criteria
+window_score_kernels = {
+    get_window_score: _window_fit_scores,
+    get_enhanced_window_score: _window_penalized_scores
+}
+
+
+def get_acceptable_following_window_arrays(time, jobs, min_window_size, verbose=False):
+    '''
+    Get the best fitting intervals for the next window,
     assuming that the previous scheduled window ended in the specified time
 
     :param time - the moment of time when the last window ended
-    :returns yields appropriate intervals (start, end) of the new window
+    :param jobs - list of jobs or a JobBatch (which keeps its timestamps presorted)
+    :returns arrays of starts and finishes of the appropriate intervals,
+             sorted by start and then by finish
     '''
 
+    if not isinstance(jobs, JobBatch):
+        jobs = JobBatch(jobs)
     max_start_time = time + min_window_size
 
-    # Construct the list of possible start times of the window
-    possible_start_time = set(filter(lambda t: time <= t < max_start_time,
-                                     [job.start for job in jobs]))
-    if len(possible_start_time) == 0 or time not in possible_start_time:
-        possible_start_time.add(time)
+    # Construct the array of possible start times of the window
+    starts = jobs.sorted_starts
+    first, last = starts.searchsorted([time, max_start_time])
+    possible_start_time = np.unique(np.append(starts[first:last], time))
     if verbose: print("Possible start:", possible_start_time)
 
-    # For each possible start of the window:
-    for start in possible_start_time:
-        # Construct the list of possible finish times of the window
-        max_finish_time = start + 2*min_window_size
-        min_finish_time = start + min_window_size
-        timestamps = chain([job.start for job in jobs],
-                           [job.finish for job in jobs])
-        possible_finish_time = set(filter(lambda t: min_finish_time <= t < max_finish_time,
-                                          timestamps))
-        if len(possible_finish_time) == 0 or min_finish_time not in possible_finish_time:
-            possible_finish_time.add(min_finish_time)
+    # Possible finish times of the window with the given start are the timestamps
+    # in [start + d, start + 2d) together with start + d itself
+    timestamps = jobs.timestamps
+    min_finish_time = possible_start_time + min_window_size
+    first = timestamps.searchsorted(min_finish_time)
+    last = timestamps.searchsorted(possible_start_time + 2*min_window_size)
+    counts = last - first
+    # Indices of the timestamps of all the slices laid out one after another
+    slice_offsets = np.repeat(first - np.cumsum(counts) + counts, counts)
+    indices = slice_offsets + np.arange(counts.sum())
+    # Add start + d unless the slice begins with it
+    bounded = timestamps[np.minimum(first, len(timestamps) - 1)] == min_finish_time
+    missing = (counts == 0) | ~bounded
+    window_starts = np.concatenate([np.repeat(possible_start_time, counts),
+                                    possible_start_time[missing]])
+    window_finishes = np.concatenate([timestamps[indices], min_finish_time[missing]])
+    order = np.lexsort((window_finishes, window_starts))
+    return window_starts[order], window_finishes[order]
 
-        # For each possible finish of the window:
-        for finish in possible_finish_time:
-            yield (start, finish)
+
+def get_acceptable_following_windows(time, jobs, min_window_size, verbose=False):
+    '''
+    Generate the best fitting intervals for the next window,
+    assuming that the previous scheduled window ended in the specified time
+    (see get_acceptable_following_window_arrays)
+
+    :returns yields appropriate intervals (start, end) of the new window
+    '''
+    window_starts, window_finishes = get_acceptable_following_window_arrays(time, jobs,
+                                                                            min_window_size,
+                                                                            verbose)
+    yield from zip(window_starts.tolist(), window_finishes.tolist())
 
 
 def distribute_intervals(interval, distribution, max_sizes, min_sizes):
@@ -107,39 +285,39 @@ def distribute_intervals(interval, distribution, max_sizes, min_sizes):
     '''
 
     assert(isinstance(interval, Interval))
-    total = sum(distribution)
+    distribution = np.asarray(distribution, dtype=np.float64)
+    max_sizes = np.asarray(max_sizes, dtype=np.float64)
+    min_sizes = np.asarray(min_sizes, dtype=np.float64)
+    total = distribution.sum()
     if total == 0:
         return []
 
     # Estimate lengths of sub-intervals
-    durations = [min(s, d / total * interval.length)
-                 for s, d in zip(max_sizes, distribution)]
+    durations = np.minimum(max_sizes, distribution / total * interval.length)
 
     # Sort them. Longer sub-intervals go first
-    order = sorted(range(len(durations)), key=lambda p: -durations[p])
-
-    # Fill the interval iteratively by sub-intervals with calculated lengths
-    # Until sub-intervals don't fit into the rest of the interval's space
-    result = [None for _ in durations]
-    start = interval.start
-    for p in order:
-        length = max(durations[p], min_sizes[p])
-        if start + length > interval.finish:
-            break
-        start += length
-
-    # Expand the intervals so they occupy as much space as possible
-    total_delta = interval.finish - start
-    start = interval.start
-    for p in order:
-        length = max(durations[p], min_sizes[p])
-        delta = max(0, min(total_delta, max_sizes[p] - length))
-        length += delta
-        total_delta -= delta
-        if start + length > interval.finish:
-            break
-        result[p] = Interval(start, start + length)
-        start += length
+    order = np.argsort(-durations, kind='stable')
+    lengths = np.maximum(durations, min_sizes)[order]
+
+    # Fill the interval by sub-intervals with calculated lengths placed one after another
+    # Until sub-intervals don't fit into the rest of the interval's space.
+    # Sub-intervals may fill the interval exactly, so its end is compared
+    # with a tolerance to the rounding errors of the sums
+    eps = 1e-9
+    ends = np.cumsum(np.append(interval.start, lengths))
+    fitted = ends[1:].searchsorted(interval.finish + eps, side='right')
+
+    # Expand the intervals so they occupy as much space as possible:
+    # each of them takes as much of the free space as the rest of the previous ones left
+    total_delta = max(0.0, interval.finish - ends[fitted])
+    room = np.maximum(0.0, max_sizes[order] - lengths)
+    deltas = np.minimum(room, np.maximum(0.0, total_delta - (np.cumsum(room) - room)))
+    ends = np.cumsum(np.append(interval.start, lengths + deltas))
+    placed = ends[1:].searchsorted(interval.finish + eps, side='right')
+    ends = np.minimum(ends, interval.finish).tolist()
+    result = [None for _ in order]
+    for k, p in enumerate(order[:placed].tolist()):
+        result[p] = Interval.unchecked(ends[k], ends[k + 1])
 
     # Return the calculated sub-intervals
     return result
@@ -153,24 +331,54 @@ class HybridSchedule:
         if isinstance(window_score, str):
             window_score = window_score_criteria[window_score]
         self.score = score
-        self.window_score = lambda w, j, t: window_score(score, w, j, t)
+        self.window_score = partial(window_score, score)
+        # Built-in window criteria can evaluate all the candidates at once
+        self.enhanced_candidates = None
+        if window_score in window_score_criteria.values():
+            self.enhanced_candidates = window_score is get_enhanced_window_score
+        # Built-in criteria are evaluated by the compiled kernel if numba is available
+        self.kernel = None
+        if (njit is not None and score in score_criteria.values() and
+                window_score in window_score_kernels):
+            self.kernel = window_score_kernels[window_score]
+            self.enhanced_weights = score is enhanced_score
         self.verbose = 0
         self.recalc_jobs = recalc_jobs
+        # The last solved network and its flow
+        self.solved_network = None
+        # The results are set by the build method
+        self.initial_jobs = self.batch = self.windows = None
+        self.network = self.compatible = self.max_flow = None
+        self.partitions_count = None
 
 
     def build(self, jobs, min_window_size):
+        self.build_from_prepared(JobBatch(jobs), min_window_size)
+
+
+    def build_from_prepared(self, prepared, min_window_size):
+        '''
+        Build the schedule for the jobs of a prepared JobBatch.
+        The batch is not modified, so the same one can be shared
+        between several schedules built for the same jobs
+        '''
 
-        # Initialize the members
-        self.jobs = deepcopy(jobs)
-        self.initial_jobs = jobs
+        # Initialize the members. The jobs themselves are never modified:
+        # the recalculated durations are kept in a copy of the batch
+        self.initial_jobs = prepared.jobs
+        self.initial_durations = prepared.durations
         self.min_window_size = min_window_size
-        self.partitions = list(set(job.partition for job in jobs))
+        self.partitions = prepared.partitions
         self.partitions_count = len(self.partitions)
+        self.batch = prepared.copy()
+        self.scores_buffer = np.empty(len(self.batch))
+        self.duration_deltas = np.zeros(len(self.batch))
+        self.step_time, self.step_arrays = None, None
 
         # Verbose output
         self.__verbose_print("Building the schedule with d={}".format(self.min_window_size))
         self.__verbose_print("Number of partitions is {}".format(self.partitions_count))
-        self.__verbose_print("Number of jobs is {}".format(len(self.jobs)))
+        self.__verbose_print("Number of jobs is {}".format(len(self.batch)))
 
         # Find the windows using a greedy strategy
         self.windows = list(self.__find_windows())
@@ -182,16 +390,16 @@ class HybridSchedule:
         self.__find_schedule()
 
 
-    def __verbose_print(self, *args, **kwargs):
-        if self.verbose > 0:
+    def __verbose_print(self, *args, level=1, **kwargs):
+        # Messages from the hot loops pass their values as arguments,
+        # so nothing is formatted unless it is going to be printed
+        if self.verbose >= level:
             print(*args, **kwargs)
 
 
-    def __getattr__(self, attr):
-        if attr in ["jobs", "windows",  "network", "jobs_distribution", "partitions_count"]:
-            raise AttributeError("You must run the build method before trying to access the resulting data")
-        else:
-            raise AttributeError("HybridSchedule instance has no attribute '{}'".format(attr))
+    def __check_built(self):
+        if self.max_flow is None:
+            raise RuntimeError("You must run the build method before trying to access the resulting data")
 
 
     def __find_windows(self):
@@ -201,8 +409,7 @@ class HybridSchedule:
 
         # Get all moments of time when some job's directive interval is starting or is finishing
         # We will further call all intervals between these moments as 'sub-intervals'
-        timestamps = sorted(set(([job.start for job in self.jobs] +
-                                 [job.finish for job in self.jobs])))
+        timestamps = self.batch.timestamps
 
         self.__verbose_print("\n ==================================== ")
         self.__verbose_print("== Searching for the set of windows ==")
@@ -210,19 +417,24 @@ class HybridSchedule:
         self.__verbose_print("Timestamps:", timestamps)
 
         # Perform steps of the greedy algorithm
-        time, count = timestamps[0], 0
-        while len(timestamps) > 0 and time + self.min_window_size <= timestamps[-1]:
+        # The greedy loop works with plain floats, so its arithmetic
+        # does not go through NumPy scalars
+        # The time only grows, so the timestamps before the current time
+        # are skipped by a cursor instead of being searched again
+        time, count, cursor = float(timestamps[0]), 0, 0
+        last_timestamp = float(timestamps[-1])
+        while len(timestamps) > 0 and time + self.min_window_size <= last_timestamp:
             self.__verbose_print("\n====| Step #{}. Time = {} |====\n".format(count, time))
             # Get all candidates for the next window
-            possible_windows = list(get_acceptable_following_windows(time, self.jobs,
-                                                                     self.min_window_size,
-                                                                     self.verbose > 0))
-            self.__verbose_print("Possible windows:", possible_windows)
-            if len(possible_windows) > 1:
+            window_starts, window_finishes = get_acceptable_following_window_arrays(
+                time, self.batch, self.min_window_size, self.verbose > 0)
+            self.__verbose_print("Possible windows:",
+                                 list(zip(window_starts.tolist(), window_finishes.tolist())))
+            if len(window_starts) > 1:
                 # If there are some, chose the best of them according to
                 # the given greedy criterion. The partition of the new window
                 # is also chosen here.
-                window = self.__find_best_window(possible_windows, time)
+                window = self.__find_best_window(window_starts, window_finishes, time)
                 self.__recalc_jobs(window, time)
                 time = window.finish
                 yield window
@@ -231,8 +443,11 @@ class HybridSchedule:
                 # (i.e. we have a very long sub-interval of length >> min_window_size)
                 # split the next sub-interval by new windows correspondingly to their weights.
                 # The weights can be also determined as the values of greedy criterion
-                finish = max(time + self.min_window_size,
-                             min(filter(lambda t: t > time, timestamps)))  # end of the sub-interval
+                # timestamps are sorted, so the end of the sub-interval
+                # is the first of them which is greater than the current time
+                cursor += timestamps[cursor:].searchsorted(time, side='right')
+                next_timestamp = float(timestamps[cursor])
+                finish = max(time + self.min_window_size, next_timestamp)
                 new_time = time
                 for window in self.__split_subinterval_by_windows(Interval(time, finish)):
                     self.__recalc_jobs(window, time)
@@ -252,36 +467,115 @@ class HybridSchedule:
         minus estimated time of their execution inside the window
         '''
 
-        scores = [max(0.0, self.window_score(window, job, time)) for job in self.jobs]
-        total = sum(scores)
+        # The scores array is a scratch buffer, so all the updates are made in place
+        scores = np.maximum(0.0, self.__window_scores(window, time), out=self.scores_buffer)
+        total = scores.sum()
         if total < 1e-6:
             return
-        deltas = [score / total * window.length for score in scores]
-        for job, delta in zip(self.jobs, deltas):
-            job.duration = max(0.01, job.duration - self.recalc_jobs * delta)
-
-
-    def __find_best_window(self, intervals, time):
+        scores /= total
+        scores *= window.length
+        scores *= self.recalc_jobs
+        # The estimated execution times are accumulated, and the durations are
+        # recalculated from the initial ones (the deltas are never negative,
+        # so this is the same as subtracting them one by one)
+        self.duration_deltas += scores
+        durations = self.batch.durations
+        np.subtract(self.initial_durations, self.duration_deltas, out=durations)
+        np.maximum(0.01, durations, out=durations)
+        self.step_time = None
+
+
+    def __find_best_window(self, window_starts, window_finishes, time):
         '''
-        Find the best window from the given set of intervals using a greedy criterion
+        Find the best window from the given arrays of intervals using a greedy criterion
         :return: best fitted window
         '''
+        if self.kernel is not None and self.verbose < 2:
+            return self.__find_best_compiled(window_starts, window_finishes, time)
+        if self.kernel is None and self.enhanced_candidates is not None:
+            return self.__find_best_candidate(window_starts, window_finishes, time)
         best_score, best_window = None, None
-        for window_start, window_finish in intervals:
+        for window_start, window_finish in zip(window_starts.tolist(), window_finishes.tolist()):
             for p in self.partitions:
                 window = Window(window_start, window_finish, p)
                 score = self.__calculate_greedy_func(window, time)
-                if self.verbose > 1:
-                    print(window, "score = {}".format(score))
+                self.__verbose_print(window, "score =", score, level=2)
                 if best_score is None or score > best_score:
                     best_score, best_window = score, window
-        self.__verbose_print("Best window is {} with score {}".format(best_window, best_score))
+        self.__verbose_print("Best window is", best_window, "with score", best_score)
+        return best_window
+
+
+    def __find_best_compiled(self, window_starts, window_finishes, time):
+        '''
+        Find the best window running the whole search in the compiled kernel
+        '''
+        batch = self.batch
+        weights, active_order, active_bounds = self.__step_arrays(time)
+        best_idx, p, best_score = _best_window(self.enhanced_candidates, window_starts,
+                                               window_finishes, self.partitions_count, time,
+                                               batch.starts, batch.finishes, batch.lengths,
+                                               weights, batch.part_ids, active_order,
+                                               active_bounds, self.scores_buffer)
+        best_window = Window.unchecked(float(window_starts[best_idx]),
+                                       float(window_finishes[best_idx]), self.partitions[p])
+        self.__verbose_print("Best window is", best_window, "with score", best_score)
+        return best_window
+
+
+    def __find_best_candidate(self, window_starts, window_finishes, time):
+        '''
+        Find the best window evaluating all the candidates in a single pass
+        '''
+        scores = get_candidate_window_scores(self.score, window_starts, window_finishes,
+                                             self.batch, time, self.enhanced_candidates)
+        self.__verbose_print("Scores of the candidates:\n", scores, level=2)
+        # argmax takes the first of equal scores, the same way the loop does
+        best_idx, p = np.unravel_index(scores.argmax(), scores.shape)
+        best_window = Window.unchecked(float(window_starts[best_idx]),
+                                       float(window_finishes[best_idx]), self.partitions[p])
+        self.__verbose_print("Best window is", best_window, "with score", scores[best_idx, p])
         return best_window
 
 
     def __calculate_greedy_func(self, window, time):
-        result = sum(self.window_score(window, job, time) for job in self.jobs)
-        return result
+        if self.kernel is None:
+            return float(self.window_score(window, self.batch, time).sum())
+        return self.__run_kernel(window, time, self.scores_buffer)
+
+
+    def __window_scores(self, window, time):
+        '''
+        Get the window scores of all the jobs.
+        The returned array may be the scratch buffer of the schedule
+        '''
+        if self.kernel is None:
+            return self.window_score(window, self.batch, time)
+        self.scores_buffer.fill(0.0)
+        self.__run_kernel(window, time, self.scores_buffer)
+        return self.scores_buffer
+
+
+    def __step_arrays(self, time):
+        '''
+        Get the weights of the kernel's score criterion and the jobs which are still
+        active. They are computed once for a greedy step: for the search of the best
+        window and for the recalculation (the weights depend on the durations,
+        so the recalculation resets them)
+        '''
+        if time != self.step_time:
+            weights = score_weights(self.enhanced_weights, self.batch, time)
+            self.step_arrays = (weights,) + self.batch.active_jobs(time)
+            self.step_time = time
+        return self.step_arrays
+
+
+    def __run_kernel(self, window, time, scores):
+        batch = self.batch
+        weights, active_order, active_bounds = self.__step_arrays(time)
+        return self.kernel(window.start, window.finish, batch.part_index[window.partition],
+                           time, batch.starts, batch.finishes, batch.lengths, weights,
+                           batch.part_ids, active_order, active_bounds, scores)
 
 
     def __split_subinterval_by_windows(self, interval):
@@ -293,63 +587,124 @@ class HybridSchedule:
         self.__verbose_print("Subinterval ({}, {}) is too long.".format(interval.start,
                                                                         interval.finish))
 
-        # Define filter that lefts only jobs of given partition p which contain the interval
-        def filter_jobs(p):
-            return filter(lambda job: job.contains(interval) and
-                                      job.partition == self.partitions[p], self.jobs)
-
-        # Get a list of acceptable jobs for each partition
-        jobs = [list(filter_jobs(p)) for p in range(self.partitions_count)]
-        # Get total durations of jobs which belong to partition p
-        # (for each partition)
-        durations = [sum(job.duration for job in jobs[p])
-                     for p in range(self.partitions_count)]
-        # Get weights (based on greedy criteria) of jobs which belong to partition p
-        # (for each partition)
-        weights = [sum(self.score(interval, job, interval.start) for job in jobs[p])
-                   for p in range(self.partitions_count)]
+        # Get the jobs which contain the interval
+        # and their weights (based on greedy criteria)
+        batch = self.batch
+        fits = batch.contains(interval)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            scores = self.score(interval.length, batch, interval.start)
+        # Get total durations and total weights of acceptable jobs
+        # which belong to partition p (for each partition)
+        part_ids = batch.part_ids[fits]
+        durations = np.bincount(part_ids, weights=batch.durations[fits],
+                                minlength=self.partitions_count)
+        weights = np.bincount(part_ids, weights=scores[fits], minlength=self.partitions_count)
 
         # distribute windows of each partition along the interval
-        min_sizes = [self.min_window_size for _ in self.partitions]
+        min_sizes = np.full(self.partitions_count, self.min_window_size, dtype=np.float64)
         window_intervals = distribute_intervals(interval, weights, durations, min_sizes)
         for p, i in enumerate(window_intervals):
             if i is not None and i.length > 0:
-                yield Window(i.start, i.finish, self.partitions[p])
+                yield Window.unchecked(i.start, i.finish, self.partitions[p])
 
 
     def __build_network(self):
-        self.network = nx.DiGraph()
-        self.network.add_node("Source")
-        self.network.add_node("Sink")
-        self.total_duration = 0
+        '''
+        Build the flow network: Source -> jobs -> windows -> Sink.
+        Vertex 0 is the source, vertices 1..J are the jobs,
+        J+1..J+W are the windows and J+W+1 is the sink.
+        The solver needs integer capacities, so all capacities are scaled
+        by a common factor chosen to keep them within int32
+        '''
+        jobs_count, windows_count = len(self.initial_jobs), len(self.windows)
+        self.source, self.sink = 0, jobs_count + windows_count + 1
+        self.total_duration = float(self.initial_durations.sum())
+        batch = self.batch
+        window_starts = np.fromiter((window.start for window in self.windows),
+                                    dtype=np.float64, count=windows_count)
+        window_finishes = np.fromiter((window.finish for window in self.windows),
+                                      dtype=np.float64, count=windows_count)
+        window_parts = np.fromiter((batch.part_index[window.partition] for window in self.windows),
+                                   dtype=np.int32, count=windows_count)
+        window_lengths = window_finishes - window_starts
+        # A power of ten keeps inputs with few decimal digits exact
+        max_total = max(self.total_duration, float(window_lengths.sum()), 1e-9)
+        self.flow_scale = float(10.0 ** np.floor(np.log10(FLOW_CAPACITY_LIMIT / max_total)))
+
+        job_vertices = self.job_vertex(np.arange(jobs_count))
+        window_vertices = self.window_vertex(np.arange(windows_count))
+
+        # Edges between jobs and windows are not limited:
+        # their capacity is the total duration of all jobs.
+        # A job is connected to the windows of its partition which it contains
+        # The (jobs, windows) compatibility matrix is kept, since the flows
+        # can only be nonzero on its edges
+        eps = 1e-3
+        self.compatible = ((batch.part_ids[:, None] == window_parts) &
+                           (window_finishes - eps <= batch.finishes[:, None]) &
+                           (window_starts + eps >= batch.starts[:, None]))
+        job_idx, window_idx = np.nonzero(self.compatible)
+
+        rows = np.concatenate([np.full(jobs_count, self.source), window_vertices,
+                               job_vertices[job_idx]])
+        cols = np.concatenate([job_vertices, np.full(windows_count, self.sink),
+                               window_vertices[window_idx]])
+        capacities = np.concatenate([self.initial_durations, window_lengths,
+                                     np.full(len(job_idx), self.total_duration)])
+
+        capacities = np.rint(capacities * self.flow_scale)
+        self.total_capacity = int(capacities[:jobs_count].sum())
+        vertices_count = self.sink + 1
+        self.network = csr_matrix((capacities.astype(np.int32), (rows, cols)),
+                                  shape=(vertices_count, vertices_count))
 
-        for i, job in enumerate(self.initial_jobs):
-            self.network.add_node((Job, i))
-            self.network.add_edge("Source", (Job, i),
-                                  {"capacity": job.duration})
-            self.total_duration += job.duration
-            y = (2 * i - len(self.initial_jobs)) / len(self.initial_jobs)
 
-        for i, window in enumerate(self.windows):
-            self.network.add_node((Window, i))
-            self.network.add_edge((Window, i), "Sink",
-                                  {"capacity": window.length})
-            y = (2 * i - len(self.windows)) / len(self.windows)
+    def __find_schedule(self):
+        # Rebuilding the schedule often yields the same network,
+        # then the flow which has been found before is reused
+        solved = self.solved_network
+        if (solved is not None and solved[0].shape == self.network.shape and
+                (solved[0] != self.network).nnz == 0):
+            self.__verbose_print("The network is unchanged, reusing its max flow")
+            self.max_flow = solved[1]
+            return
+        self.max_flow = maximum_flow(self.network, self.source, self.sink)
+        self.solved_network = (self.network, self.max_flow)
 
-        max_capacity = sum(job.duration for job in self.initial_jobs)
 
-        for job_idx, job in enumerate(self.initial_jobs):
-            for window_idx, window in enumerate(self.windows):
-                if job.contains(window) and job.partition == window.partition:
-                    self.network.add_edge((Job, job_idx), (Window, window_idx))
+    def job_vertex(self, job_idx):
+        return 1 + job_idx
 
 
-    def __find_schedule(self):
-        self.residual_network = preflow_push(self.network, "Source", "Sink")
+    def window_vertex(self, window_idx):
+        return 1 + len(self.initial_jobs) + window_idx
+
+
+    def get_flow(self, job_idx, window_idx):
+        '''
+        Get the amount of work of the job scheduled into the window
+        '''
+        self.__check_built()
+        flow = self.max_flow.flow[self.job_vertex(job_idx), self.window_vertex(window_idx)]
+        return flow / self.flow_scale
+
+
+    def get_flows(self):
+        '''
+        Get the matrix (jobs, windows) of the amounts of work
+        of the jobs scheduled into the windows
+        '''
+        self.__check_built()
+        flows = np.zeros(self.compatible.shape)
+        job_idx, window_idx = np.nonzero(self.compatible)
+        edges = self.max_flow.flow[self.job_vertex(job_idx), self.window_vertex(window_idx)]
+        flows[job_idx, window_idx] = np.asarray(edges).ravel() / self.flow_scale
+        return flows
 
 
     def rate(self):
-        return 1.0 + (self.residual_network.graph['flow_value'] - self.total_duration) / self.total_duration
+        self.__check_built()
+        return self.max_flow.flow_value / self.total_capacity
 
     def exists(self):
         return self.rate() >= 0.99
@@ -375,11 +730,10 @@ def main():
     print("n_windows = {}".format(len(s.windows)))
     for window in s.windows:
         print(window.start, window.finish, window.partition)
+    flows = s.get_flows()
     for job_idx, job in enumerate(s.initial_jobs):
         for window_idx, window in enumerate(s.windows):
-            edge = s.residual_network.get_edge_data((Job, job_idx), (Window, window_idx),
-                                                    default={"flow" : 0.0})
-            print(edge["flow"] / job.duration, end=" ")
+            print(flows[job_idx, window_idx] / job.duration, end=" ")
         print()
 
 
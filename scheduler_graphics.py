@@ -98,52 +98,52 @@ def plot_network(schedule, colored=True):
     windows_count = len(schedule.windows)
     x_step = 0.5 / (max(windows_count, jobs_count)) ** 0.5
 
+    # Rebuild the flow network as a networkx graph just for drawing it
+    network = nx.DiGraph()
+    capacities = schedule.network.tocoo()
+    network.add_edges_from(zip(capacities.row.tolist(), capacities.col.tolist()))
+
     vertex_positions = dict()
     vertex_labels, edge_labels = dict(), dict()
-    vertex_positions["Source"] = (0, 0)
-    vertex_positions["Sink"] = (3 * x_step, 0)
+    vertex_positions[schedule.source] = (0, 0)
+    vertex_positions[schedule.sink] = (3 * x_step, 0)
 
     partition_lists = {p: [] for p in schedule.partitions}
     colors = get_partitions_palette(schedule.partitions, saturation=0.35, value=0.8)
 
     for i, job in enumerate(schedule.initial_jobs):
         y = - (2 * i + 1 - jobs_count) / jobs_count
-        vertex_positions[(Job, i)] = (x_step, y)
-        vertex_labels[(Job, i)] = str(i)
-        partition_lists[job.partition].append((Job, i))
+        v = schedule.job_vertex(i)
+        vertex_positions[v] = (x_step, y)
+        vertex_labels[v] = str(i)
+        partition_lists[job.partition].append(v)
 
     for i, window in enumerate(schedule.windows):
         y = - (2 * i + 1 - windows_count) / windows_count
-        vertex_positions[(Window, i)] = (2 * x_step, y)
-        vertex_labels[(Window, i)] = str(i)
-        partition_lists[window.partition].append((Window, i))
-
-    for v, w, data in schedule.network.edges(data=True):
-        if not (v[0] is Job and w[0] is Window):
-            edge_labels[(v, w)] = "{:.1f}".format(float(data["capacity"]))
-            try:
-                edge_flow = schedule.residual_network[v][w]['flow']
-                edge_labels[(v, w)] = "{:.1f}/{}".format(float(edge_flow), edge_labels[(v, w)])
-            except AttributeError:
-                pass
+        v = schedule.window_vertex(i)
+        vertex_positions[v] = (2 * x_step, y)
+        vertex_labels[v] = str(i)
+        partition_lists[window.partition].append(v)
+
+    for v, w, capacity in zip(capacities.row, capacities.col, capacities.data):
+        edge_flow = schedule.max_flow.flow[v, w] / schedule.flow_scale
+        if v == schedule.source or w == schedule.sink:
+            edge_labels[(v, w)] = "{:.1f}/{:.1f}".format(edge_flow,
+                                                         capacity / schedule.flow_scale)
         else:
-            try:
-                edge_flow = schedule.residual_network[v][w]['flow']
-                edge_labels[(v, w)] = "{:.1f}".format(float(edge_flow))
-            except AttributeError:
-                pass
+            edge_labels[(v, w)] = "{:.1f}".format(edge_flow)
 
     for p in schedule.partitions:
         c = [tuple(colors[p])] * len(partition_lists[p])
-        nx.draw_networkx_nodes(schedule.network, vertex_positions,
+        nx.draw_networkx_nodes(network, vertex_positions,
                                nodelist=partition_lists[p],
                                node_color=c, alpha=1.0)
-    nx.draw_networkx_nodes(schedule.network, vertex_positions,
-                           nodelist=["Source", "Sink"],
-                           node_color=(0.5, 0.5, 0.5))
-    nx.draw_networkx_labels(schedule.network, vertex_positions, labels=vertex_labels)
-    nx.draw_networkx_edges(schedule.network, vertex_positions, arrows=False)
-    nx.draw_networkx_edge_labels(schedule.network, vertex_positions, edge_labels=edge_labels)
+    nx.draw_networkx_nodes(network, vertex_positions,
+                           nodelist=[schedule.source, schedule.sink],
+                           node_color=[(0.5, 0.5, 0.5)] * 2)
+    nx.draw_networkx_labels(network, vertex_positions, labels=vertex_labels)
+    nx.draw_networkx_edges(network, vertex_positions, arrows=False)
+    nx.draw_networkx_edge_labels(network, vertex_positions, edge_labels=edge_labels)
     plt.show()
 
 
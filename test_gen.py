@@ -2,7 +2,8 @@ __author__ = 'Artem Bishev'
 
 
 import random
-from heapq import merge
+import numpy as np
+from bisect import bisect_left, insort
 from schedule_entities import Job, Window
 from scheduler_graphics import plot_windows, plot_network
 import scheduler
@@ -22,11 +23,13 @@ def generate_windows_one_partition(min_size, max_size, total_len):
 
 
 def rate_monotonic_order(rates, items):
-    ordered_generators = [[(i / rate, key, item) for i, item in enumerate(items[key])]
-                          for key, rate in rates.items()]
-    for _, key, item in merge(*ordered_generators):
-        yield key, item
-
+    keys = sorted(rates)
+    # Items are ordered by i / rate, the ties are ordered by key,
+    # so the stable sort is done over the items laid out in the order of the keys
+    positions = np.concatenate([np.arange(len(items[key])) / rates[key] for key in keys])
+    owners = [(key, item) for key in keys for item in items[key]]
+    for idx in np.argsort(positions, kind='stable').tolist():
+        yield owners[idx]
 
 def generate_windows(min_size, max_size, partitions, total_len):
     window_sizes, rates = dict(), dict()
@@ -39,24 +42,38 @@ def generate_windows(min_size, max_size, partitions, total_len):
         time += size
 
 
-def generate_jobs(windows, hardness, min_duration, max_duration, load_factor):
+def uniform_draws(rng, batch_size=4096):
+    '''
+    Infinite stream of uniform [0, 1) floats drawn from the generator in batches
+    '''
+    while True:
+        yield from rng.random(batch_size).tolist()
+
+
+def generate_jobs(windows, hardness, min_duration, max_duration, load_factor, rng=None):
+    draws = uniform_draws(np.random.default_rng() if rng is None else rng)
     free_space = [w.length for w in windows]
     total_windows_length = sum(free_space)
     total_jobs_length = 0
-    while max(free_space) > min_duration and total_jobs_length < load_factor * total_windows_length:
-        duration = random.uniform(min_duration, max_duration)
-        matching_indices = [idx for idx, s in enumerate(free_space) if s >= duration]
-        if len(matching_indices) == 0:
+    # Pairs (free space, window index) kept sorted, so the largest free space
+    # is the last pair and the windows which can fit a job are found by bisection
+    free_windows = sorted((s, idx) for idx, s in enumerate(free_space))
+    while free_windows[-1][0] > min_duration and total_jobs_length < load_factor * total_windows_length:
+        duration = min_duration + (max_duration - min_duration) * next(draws)
+        first_matching = bisect_left(free_windows, (duration, -1))
+        if first_matching == len(free_windows):
             continue
-        idx = random.choice(matching_indices)
+        position = first_matching + int((len(free_windows) - first_matching) * next(draws))
+        _, idx = free_windows.pop(position)
         # h = random.expovariate(1.0 / (hardness - 1.0)) + 1.0
         r = windows[idx].length * (hardness - 1.0)
-        a = random.uniform(0.0, 1.0)
+        a = next(draws)
         start = windows[idx].start - r * a
         finish = windows[idx].finish + r * (1.0 - a)
         partition = windows[idx].partition
         yield Job(start, finish, partition, duration)
         free_space[idx] -= duration
+        insort(free_windows, (free_space[idx], idx))
         total_jobs_length += duration
 
 
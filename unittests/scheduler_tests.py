@@ -2,8 +2,13 @@
 
 __author__ = 'Artem Bishev'
 
-from schedule_entities import IntervalError, Job, Window, Interval
-from scheduler import get_acceptable_following_windows, distribute_intervals
+from schedule_entities import IntervalError, Job, JobBatch, Window, Interval
+from scheduler import get_acceptable_following_windows, get_acceptable_following_window_arrays
+from scheduler import distribute_intervals
+from copy import deepcopy
+from itertools import product
+import numpy as np
+import scheduler
 import unittest
 
 
@@ -11,24 +16,28 @@ class BasicEntitiesTests(unittest.TestCase):
     '''
     Test capabilities of basic entities related to schedules
     '''
-    def test_interval_exceptions(self):
-        with self.assertRaises(IntervalError):
-            a = Interval(2, 1)
-        with self.assertRaises(IntervalError):
-            b = Job(3, 1, 1, 1)
-        with self.assertRaises(IntervalError):
-            c = Window(3, 1, 1)
-        d = Window(1, 1, 1)
-        e = Window(-3, -2, 1)
-
-    def test_job_exceptions(self):
-        with self.assertRaises(ValueError):
-            a = Job(1, 3, 1, 3)
-        with self.assertRaises(ValueError):
-            b = Job(1, 3, 1, -1)
+    # (entity, constructor arguments, expected exception)
+    INVALID_ENTITIES = ((Interval, (2, 1), IntervalError),
+                        (Job, (3, 1, 1, 1), IntervalError),
+                        (Window, (3, 1, 1), IntervalError),
+                        (Job, (1, 3, 1, 3), ValueError),
+                        (Job, (1, 3, 1, -1), ValueError))
+
+    def test_exceptions(self):
+        for entity, args, exception in self.INVALID_ENTITIES:
+            with self.subTest(entity=entity.__name__, args=args):
+                self.assertRaises(exception, entity, *args)
+        a = Window(1, 1, 1)
+        b = Window(-3, -2, 1)
         c = Job(100, 200, 1, 100)
         d = Job(-3, -1, 1, 0)
 
+    def test_unchecked(self):
+        window = Window.unchecked(1, 3, 2)
+        self.assertEqual(window, Window(1, 3, 2))
+        self.assertEqual((window.length, window.partition), (2, 2))
+        self.assertEqual(Interval.unchecked(0, 1), Interval(0, 1))
+
     def test_contains(self):
         ad = Interval(0, 3)
         ab = Interval(0, 1)
@@ -36,128 +45,137 @@ class BasicEntitiesTests(unittest.TestCase):
         bd = Job(1, 3, 1, 1)
         bc = Window(1, 2, 2)
         z = Interval(1.5, 1.5)
-        for x in [ad, ab, ac, bd, bc, z]:
-            self.assertTrue(ad.contains(x))
-            self.assertTrue(x.contains(x))
-        for x in [ad, ac, bd, bc]:
-            self.assertTrue(x.contains(z))
-            self.assertFalse(z.contains(x))
-        self.assertTrue(bd.contains(bc))
-        self.assertTrue(ac.contains(bc))
-        self.assertTrue(ac.contains(ab))
-        self.assertFalse(ab.contains(bc))
-        self.assertFalse(bd.contains(ab))
-        self.assertFalse(ab.contains(z))
+        intervals = [ad, ab, ac, bd, bc, z]
+        # expected[i, j] is whether the i-th interval contains the j-th one
+        expected = np.array([[1, 1, 1, 1, 1, 1],
+                             [0, 1, 0, 0, 0, 0],
+                             [0, 1, 1, 0, 1, 1],
+                             [0, 0, 0, 1, 1, 1],
+                             [0, 0, 0, 0, 1, 1],
+                             [0, 0, 0, 0, 0, 1]], dtype=bool)
+        contains = np.array([[x.contains(y) for y in intervals] for x in intervals])
+        np.testing.assert_array_equal(contains, expected)
+        # JobBatch computes a column of the matrix at once
+        batch = JobBatch([Job(x.start, x.finish, 0, 0) for x in intervals])
+        contains = np.column_stack([batch.contains(y).copy() for y in intervals])
+        np.testing.assert_array_equal(contains, expected)
 
     def test_eq(self):
         self.assertEqual(Interval(0, 3), Job(0, 3, 1, 1))
         self.assertNotEqual(Window(0, 3, 1), Window(1, 3, 1))
+        self.assertEqual(hash(Interval(0, 3)), hash(Job(0, 3, 1, 1)))
+        self.assertEqual(len({Window(0, 3, 1), Window(0, 3, 2), Window(1, 3, 1)}), 2)
+
+    def test_slots(self):
+        job = Job(1, 4, 'A', 2)
+        self.assertEqual(job.length, 3)
+        self.assertFalse(hasattr(job, '__dict__'))
+        copied = deepcopy(job)
+        self.assertEqual(copied, job)
+        self.assertEqual((copied.partition, copied.duration, copied.length), ('A', 2, 3))
+
+    def test_job_batch(self):
+        jobs = [Job(0, 10, 'A', 5), Job(5, 15, 'B', 3), Job(10, 12, 'A', 2)]
+        batch = JobBatch(jobs, ['B', 'A'])
+        self.assertEqual(len(batch), 3)
+        self.assertEqual(list(batch.starts), [0, 5, 10])
+        self.assertEqual(list(batch.finishes), [10, 15, 12])
+        self.assertEqual(list(batch.durations), [5, 3, 2])
+        self.assertEqual(list(batch.lengths), [10, 10, 2])
+        self.assertEqual(list(batch.part_ids), [1, 0, 1])
+        self.assertEqual(list(batch.partition_order), [1, 0, 2])
+        self.assertEqual(list(batch.partition_bounds), [0, 1, 3])
+        order, bounds = batch.active_jobs(11)
+        self.assertEqual((list(order), list(bounds)), ([1, 2], [0, 1, 2]))
+        self.assertEqual(set(JobBatch(jobs).partitions), {'A', 'B'})
 
 
 class FindWindowsTests(unittest.TestCase):
     '''
     Test get_acceptable_following_windows function
     '''
-    def setUp(self):
-        self.jobs = [Job(0,  10, 0, 5),
-                     Job(5,  15, 0, 5),
-                     Job(10, 20, 1, 5),
-                     Job(20, 23, 2, 2),
-                     Job(25, 30, 2, 4),
-                     Job(40, 50, 1, 2),
-                     Job(40, 50, 2, 2),
-                     Job(40, 60, 1, 5),
-                     Job(80, 100, 0, 10),
-                     Job(90, 100, 0, 8)]
+    @classmethod
+    def setUpClass(cls):
+        cls.jobs = (Job(0,  10, 0, 5),
+                    Job(5,  15, 0, 5),
+                    Job(10, 20, 1, 5),
+                    Job(20, 23, 2, 2),
+                    Job(25, 30, 2, 4),
+                    Job(40, 50, 1, 2),
+                    Job(40, 50, 2, 2),
+                    Job(40, 60, 1, 5),
+                    Job(80, 100, 0, 10),
+                    Job(90, 100, 0, 8))
+        cls.batch = JobBatch(cls.jobs)
         # timestamps:
         #     10----20                 40------60
         # 0---10    20---23  25---30   40---50     80-------100
         #   5----15                    40---50         90---100
 
-    def test_simple_case(self):
-        windows_list = list(get_acceptable_following_windows(19, self.jobs, 5))
-        self.assertEqual(len(windows_list), 3)
-        windows = set(windows_list)
-        self.assertEqual(len(windows), 3)
-        self.assertIn((19, 24), windows)
-        self.assertIn((19, 25), windows)
-        self.assertIn((20, 25), windows)
+    # (time, min window size, expected windows)
+    CASES = ((19, 5, frozenset({(19, 24), (19, 25), (20, 25)})),
+             (0, 5, frozenset({(0, 5)})),
+             (0, 6, frozenset({(0, 6), (0, 10), (5, 11), (5, 15)})),
+             (0, 10, frozenset({(0, 10), (0, 15), (5, 15), (5, 20), (5, 23)})),
+             (35, 10, frozenset({(35, 45), (35, 50), (40, 50)})),
+             (35, 8, frozenset({(35, 43), (35, 50), (40, 48), (40, 50)})),
+             (29, 10, frozenset({(29, 39), (29, 40)})),
+             (31, 2, frozenset({(31, 33)})),
+             (25, 5, frozenset({(25, 30)})))
+
+    def _drain_unique(self, windows, expected):
+        '''
+        Consume the windows once and check that they are unique and equal to the expected ones
+        '''
+        windows_list = list(windows)
+        windows = frozenset(windows_list)
+        self.assertEqual(len(windows_list), len(windows))
+        self.assertEqual(windows, expected)
+
+    def test_windows(self):
+        for time, min_window_size, expected in self.CASES:
+            with self.subTest(time=time, min_window_size=min_window_size):
+                self._drain_unique(get_acceptable_following_windows(time, self.jobs,
+                                                                    min_window_size), expected)
+
+    def test_windows_of_batch(self):
+        for time, min_window_size, expected in self.CASES:
+            with self.subTest(time=time, min_window_size=min_window_size):
+                windows = get_acceptable_following_windows(time, self.batch, min_window_size)
+                self.assertEqual(list(windows),
+                                 list(get_acceptable_following_windows(time, self.jobs,
+                                                                       min_window_size)))
 
     def test_min_window_size(self):
         min_window_size = 24
-        windows_list = list(get_acceptable_following_windows(2, self.jobs, min_window_size))
-        for window in windows_list:
-            self.assertGreaterEqual(window[1] - window[0], min_window_size)
-            self.assertLess(window[1] - window[0], 2*min_window_size)
-
-    def test_borders_0(self):
-        windows_list = list(get_acceptable_following_windows(0, self.jobs, 5))
-        self.assertEqual(len(windows_list), 1)
-        windows = set(windows_list)
-        self.assertEqual(len(windows), 1)
-        self.assertIn((0, 5), windows)
-
-    def test_borders_1(self):
-        windows_list = list(get_acceptable_following_windows(0, self.jobs, 6))
-        self.assertEqual(len(windows_list), 4)
-        windows = set(windows_list)
-        self.assertEqual(len(windows), 4)
-        self.assertIn((0, 6), windows)
-        self.assertIn((0, 10), windows)
-        self.assertIn((5, 11), windows)
-        self.assertIn((5, 15), windows)
-
-    def test_borders_2(self):
-        windows_list = list(get_acceptable_following_windows(0, self.jobs, 10))
-        self.assertEqual(len(windows_list), 5)
-        windows = set(windows_list)
-        self.assertEqual(len(windows), 5)
-        self.assertIn((0, 10), windows)
-        self.assertIn((0, 15), windows)
-        self.assertIn((5, 15), windows)
-        self.assertIn((5, 20), windows)
-        self.assertIn((5, 23), windows)
-
-    def test_borders_3(self):
-        windows_list = list(get_acceptable_following_windows(35, self.jobs, 10))
-        self.assertEqual(len(windows_list), 3)
-        windows = set(windows_list)
-        self.assertEqual(len(windows), 3)
-        self.assertIn((35, 45), windows)
-        self.assertIn((35, 50), windows)
-        self.assertIn((40, 50), windows)
-
-    def test_borders_4(self):
-        windows_list = list(get_acceptable_following_windows(35, self.jobs, 8))
-        self.assertEqual(len(windows_list), 4)
-        windows = set(windows_list)
-        self.assertEqual(len(windows), 4)
-        self.assertIn((35, 43), windows)
-        self.assertIn((35, 50), windows)
-        self.assertIn((40, 48), windows)
-        self.assertIn((40, 50), windows)
-
-    def test_borders_5(self):
-        windows_list = list(get_acceptable_following_windows(29, self.jobs, 10))
-        self.assertEqual(len(windows_list), 2)
-        windows = set(windows_list)
-        self.assertEqual(len(windows), 2)
-        self.assertIn((29, 39), windows)
-        self.assertIn((29, 40), windows)
-
-    def test_no_timestamps(self):
-        windows_list = list(get_acceptable_following_windows(31, self.jobs, 2))
-        self.assertEqual(len(windows_list), 1)
-        windows = set(windows_list)
-        self.assertEqual(len(windows), 1)
-        self.assertIn((31, 33), windows)
-
-    def test_one_window(self):
-        windows_list = list(get_acceptable_following_windows(25, self.jobs, 5))
-        self.assertEqual(len(windows_list), 1)
-        windows = set(windows_list)
-        self.assertEqual(len(windows), 1)
-        self.assertIn((25, 30), windows)
+        starts, finishes = get_acceptable_following_window_arrays(2, self.jobs, min_window_size)
+        sizes = finishes - starts
+        self.assertGreater(len(sizes), 0)
+        self.assertTrue(np.all(sizes >= min_window_size),
+                        "Too short window of size {}".format(sizes.min()))
+        self.assertTrue(np.all(sizes < 2*min_window_size),
+                        "Too long window of size {}".format(sizes.max()))
+
+    def test_window_invariants(self):
+        timestamps = set(self.batch.timestamps.tolist())
+        job_starts = set(self.batch.starts.tolist())
+        for time, min_window_size in product(range(101), range(1, 31)):
+            windows = list(get_acceptable_following_windows(time, self.batch, min_window_size))
+            self.assertEqual(len(windows), len(set(windows)))
+            for start, finish in windows:
+                self.assertTrue(start == time or start in job_starts)
+                self.assertTrue(time <= start < time + min_window_size)
+                self.assertTrue(min_window_size <= finish - start < 2*min_window_size)
+                self.assertTrue(finish == start + min_window_size or finish in timestamps)
+
+    def test_window_arrays(self):
+        for time, min_window_size in product([0, 2, 19, 29, 35], [2, 5, 8, 10, 24]):
+            starts, finishes = get_acceptable_following_window_arrays(time, self.jobs,
+                                                                      min_window_size)
+            windows = list(zip(starts.tolist(), finishes.tolist()))
+            self.assertEqual(windows, sorted(set(windows)))
+            self.assertEqual(windows, list(get_acceptable_following_windows(time, self.jobs,
+                                                                            min_window_size)))
 
 
 class DistributeIntervalsTest(unittest.TestCase):
@@ -192,5 +210,121 @@ class DistributeIntervalsTest(unittest.TestCase):
         self.assertEqual(intervals[0], Interval(0, 1))
         self.assertIs(intervals[1], None)
 
+    def test_exact_fit(self):
+        # 0.2 + 0.1 exceeds 0.3 by a rounding error
+        interval = Interval(0, 0.3)
+        intervals = distribute_intervals(interval, [1.0, 2.0], [0.1, 0.2], [0.1, 0.2])
+        self.assertEqual(intervals[1], Interval(0, 0.2))
+        self.assertEqual(intervals[0], Interval(0.2, 0.3))
+
 class SchedulerTests(unittest.TestCase):
-    pass
+    def setUp(self):
+        self.jobs = [Job(0, 35, 'A', 10),
+                     Job(2, 20, 'B', 5),
+                     Job(0, 20, 'B', 5),
+                     Job(2, 20, 'C', 5),
+                     Job(18, 28, 'D', 6),
+                     Job(23, 35, 'B', 4),
+                     Job(24, 30, 'C', 3)]
+
+    def test_build(self):
+        s = scheduler.HybridSchedule()
+        s.build(self.jobs, 3)
+        self.assertGreater(len(s.windows), 0)
+        windows = sorted(s.windows, key=lambda window: window.start)
+        for previous, window in zip(windows, windows[1:]):
+            self.assertLessEqual(previous.finish, window.start + 1e-9)
+        self.assertGreater(s.rate(), 0.0)
+        self.assertLessEqual(s.rate(), 1.0)
+        for job_idx, job in enumerate(self.jobs):
+            scheduled = 0.0
+            for window_idx, window in enumerate(s.windows):
+                flow = s.get_flow(job_idx, window_idx)
+                if flow > 0:
+                    self.assertEqual(job.partition, window.partition)
+                    self.assertTrue(job.contains(window))
+                scheduled += flow
+            self.assertLessEqual(scheduled, job.duration + 1e-6)
+        flows = s.get_flows()
+        self.assertEqual(flows.shape, (len(self.jobs), len(s.windows)))
+        self.assertEqual(flows[~s.compatible].sum(), 0.0)
+        for job_idx, window_idx in product(range(len(self.jobs)), range(len(s.windows))):
+            self.assertEqual(flows[job_idx, window_idx], s.get_flow(job_idx, window_idx))
+
+    def test_not_built(self):
+        s = scheduler.HybridSchedule()
+        self.assertIsNone(s.windows)
+        with self.assertRaises(RuntimeError):
+            s.rate()
+        with self.assertRaises(RuntimeError):
+            s.get_flow(0, 0)
+
+    def test_build_from_prepared(self):
+        batch = JobBatch(self.jobs)
+        durations = batch.durations.copy()
+        rates = []
+        for _ in range(2):
+            s = scheduler.HybridSchedule()
+            s.build_from_prepared(batch, 3)
+            rates.append(s.rate())
+        np.testing.assert_array_equal(batch.durations, durations)
+        self.assertEqual(rates[0], rates[1])
+
+    def test_reuse_max_flow(self):
+        s = scheduler.HybridSchedule()
+        s.build(self.jobs, 3)
+        max_flow = s.max_flow
+        s.build(self.jobs, 3)
+        self.assertIs(s.max_flow, max_flow)
+        s.build(self.jobs, 4)
+        self.assertIsNot(s.max_flow, max_flow)
+        self.assertLessEqual(s.rate(), 1.0)
+
+    def test_candidate_window_scores(self):
+        batch = JobBatch(self.jobs)
+        intervals = [(2, 6), (18, 21), (24, 28), (0, 20)]
+        for score, window_score in product(['default', 'enhanced'], repeat=2):
+            score_func = scheduler.score_criteria[score]
+            window_score_func = scheduler.window_score_criteria[window_score]
+            scores = scheduler.get_candidate_window_scores(score_func, *zip(*intervals), batch, 1,
+                                                           window_score == 'enhanced')
+            self.assertEqual(scores.shape, (len(intervals), len(batch.partitions)))
+            for (w, (start, finish)), (p, partition) in product(enumerate(intervals),
+                                                                enumerate(batch.partitions)):
+                expected = window_score_func(score_func, Window(start, finish, partition), batch, 1)
+                self.assertAlmostEqual(scores[w, p], expected.sum())
+
+    @unittest.skipIf(scheduler.njit is None, "numba is not installed")
+    def test_kernel_matches_criteria(self):
+        batch = JobBatch(self.jobs)
+        windows = [Window(2, 6, 'B'), Window(18, 21, 'C'), Window(24, 28, 'A')]
+        for score, window_score in product(['default', 'enhanced'], repeat=2):
+            flags = (score == 'enhanced', window_score == 'enhanced')
+            score = scheduler.score_criteria[score]
+            window_score = scheduler.window_score_criteria[window_score]
+            for window in windows:
+                expected = window_score(score, window, batch, 1)
+                scores = np.zeros(len(batch))
+                kernel = scheduler.window_score_kernels[window_score]
+                total = kernel(window.start, window.finish, batch.part_index[window.partition], 1,
+                               batch.starts, batch.finishes, batch.lengths,
+                               scheduler.score_weights(flags[0], batch, 1), batch.part_ids,
+                               batch.partition_order, batch.partition_bounds, scores)
+                np.testing.assert_allclose(scores, expected)
+                self.assertAlmostEqual(total, expected.sum())
+
+    @unittest.skipIf(scheduler.njit is None, "numba is not installed")
+    def test_best_window_kernel(self):
+        batch = JobBatch(self.jobs)
+        starts, finishes = np.array([2, 18, 24, 0, 5], dtype=np.float64), np.array([6, 21, 28, 20, 9.5])
+        for score, window_score in product(['default', 'enhanced'], repeat=2):
+            flags = (score == 'enhanced', window_score == 'enhanced')
+            expected = scheduler.get_candidate_window_scores(scheduler.score_criteria[score],
+                                                             starts, finishes, batch, 1, flags[1])
+            w, p, total = scheduler._best_window(flags[1], starts, finishes, len(batch.partitions), 1,
+                                                 batch.starts, batch.finishes, batch.lengths,
+                                                 scheduler.score_weights(flags[0], batch, 1),
+                                                 batch.part_ids, batch.partition_order,
+                                                 batch.partition_bounds, np.empty(len(batch)))
+            self.assertEqual((w, p), np.unravel_index(expected.argmax(), expected.shape))
+            self.assertAlmostEqual(total, expected.max())